@@ -1,18 +1,21 @@
 # %%
 import argparse
-import webbrowser
 from pathlib import Path
-import uvicorn
 import sys
 
 from simple_mbtiles_server.config import Config
-from simple_mbtiles_server.server import create_app
+from simple_mbtiles_server.cli import default_workers, serve
 
 def main():
     parser = argparse.ArgumentParser(description="Simple MBTiles Server")
     parser.add_argument("mbtiles_file", type=str, nargs='?', help="Path to MBTiles file")
     parser.add_argument("--start-browser", action="store_true", help="Open browser automatically")
     parser.add_argument("--port", type=int, default=8765, help="Port to start server (default: 8765)")
+    parser.add_argument("--workers", type=int, default=default_workers(),
+                        help="Number of worker processes, 1 runs a single uvicorn process (default: 2 x cores + 1)")
+    parser.add_argument("--optimize", action="store_true",
+                        help="Add a covering tile index to a tiles table that has no (z, x, y) index, "
+                             "roughly doubling its size; indexed files and tile views are left untouched")
     args = parser.parse_args()
     
     if not args.mbtiles_file:
@@ -22,15 +25,12 @@ def main():
     config = Config(
         mbtiles_file=Path(args.mbtiles_file),
         start_browser=args.start_browser,
-        port=args.port
+        port=args.port,
+        workers=args.workers,
+        optimize=args.optimize
     )
     
-    app = create_app(config.mbtiles_file)
-    
-    if config.start_browser:
-        webbrowser.open(f"http://{config.host}:{config.port}/static/index.html")
-    
-    uvicorn.run(app, host=config.host, port=config.port)
+    serve(config)
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -1,12 +1,65 @@
 # %%
 import argparse
+import importlib.util
+import os
 import webbrowser
 from pathlib import Path
 import uvicorn
 import sys
 
 from .config import Config
-from .server import create_app
+from .core import optimize
+from .server import create_app, MBTILES_FILE_ENV, STATIC_DIR_ENV
+
+# %%
+def default_workers() -> int:
+    """Number of worker processes to run, (2 x cores) + 1"""
+    return (os.cpu_count() or 1) * 2 + 1
+
+def run_gunicorn(config: Config):
+    """Replace the current process with gunicorn running Uvicorn workers
+
+    Each worker builds its own app through create_app_factory.
+    """
+    os.environ[MBTILES_FILE_ENV] = str(config.mbtiles_file)
+    if config.static_dir:
+        os.environ[STATIC_DIR_ENV] = config.static_dir
+    os.execv(sys.executable, [
+        sys.executable, "-m", "gunicorn",
+        "-k", "uvicorn_worker.UvicornWorker",
+        "-w", str(config.workers),
+        "-b", f"{config.host}:{config.port}",
+        "simple_mbtiles_server.server:create_app_factory()",
+    ])
+
+def serve(config: Config):
+    """Serve the MBTiles file, across several processes if configured"""
+    if not config.mbtiles_file.exists():
+        print(f"MBTiles file not found: {config.mbtiles_file}")
+        sys.exit(2)
+
+    if config.optimize:
+        if optimize(config.mbtiles_file):
+            print("Added covering tile index")
+        else:
+            print("Tiles already have a (z, x, y) index or are a view, nothing to optimize")
+
+    if config.workers > 1:
+        if os.name == "nt":
+            print("gunicorn does not run on Windows, falling back to a single process")
+            config.workers = 1
+        elif any(importlib.util.find_spec(name) is None for name in ("gunicorn", "uvicorn_worker")):
+            print("gunicorn or uvicorn-worker is not installed, falling back to a single process")
+            config.workers = 1
+
+    if config.start_browser:
+        webbrowser.open(f"http://{config.host}:{config.port}/static/index.html")
+
+    if config.workers > 1:
+        run_gunicorn(config)
+    else:
+        app = create_app(config.mbtiles_file, static_dir=config.static_dir)
+        uvicorn.run(app, host=config.host, port=config.port)
 
 # %%
 def main():
@@ -15,26 +68,28 @@ def main():
     parser.add_argument("--start-browser", action="store_true", help="Open browser automatically")
     parser.add_argument("--port", type=int, default=8765, help="Port to start server (default: 8765)")
     parser.add_argument("--static-dir", type=str, help="Directory for static files (optional)")
+    parser.add_argument("--workers", type=int, default=default_workers(),
+                        help="Number of worker processes, 1 runs a single uvicorn process (default: 2 x cores + 1)")
+    parser.add_argument("--optimize", action="store_true",
+                        help="Add a covering tile index to a tiles table that has no (z, x, y) index, "
+                             "roughly doubling its size; indexed files and tile views are left untouched")
     args = parser.parse_args()
-    
+
     if not args.mbtiles_file:
         print("No mbtiles file specified")
         sys.exit(2)
-    
+
     config = Config(
         mbtiles_file=Path(args.mbtiles_file),
         start_browser=args.start_browser,
         port=args.port,
-        static_dir=args.static_dir if args.static_dir else None
+        static_dir=args.static_dir if args.static_dir else None,
+        workers=args.workers,
+        optimize=args.optimize
     )
-    
-    app = create_app(config.mbtiles_file, static_dir=config.static_dir)
-    
-    if config.start_browser:
-        webbrowser.open(f"http://{config.host}:{config.port}/static/index.html")
-    
-    uvicorn.run(app, host=config.host, port=config.port)
+
+    serve(config)
 
 # %%
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
@@ -10,4 +10,6 @@ class Config:
     start_browser: bool = False
     port: int = 8765
     host: str = "127.0.0.1"
-    static_dir: Optional[str] = None 
\ No newline at end of file
+    static_dir: Optional[str] = None
+    workers: int = 1
+    optimize: bool = False 
\ No newline at end of file
@@ -1,44 +1,164 @@
 # %%
 #|export
+import queue
 import sqlite3
+import threading
 from pathlib import Path
-from typing import Optional, Dict, Union
+from typing import Optional, Dict, Union, List, Iterable, Tuple
 import contextlib
 
+def flip_y(zoom: int, y: int) -> int:
+    """Convert between TMS and XYZ tile coordinates
+
+    The tile lookups inline this expression to avoid a call per request.
+    """
+    return (1 << zoom) - 1 - y
+
 class MBTilesDB:
-    def __init__(self, db_path: Union[str, Path]):
+    # Kept as constants so sqlite3's per-connection statement cache, which is
+    # keyed by SQL text, reuses the compiled statements on every call
+    _META_SQL = 'SELECT name, value FROM metadata'
+    _TILE_SQL = 'SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?'
+    _TILES_SQL = (
+        'SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles '
+        'WHERE (zoom_level, tile_column, tile_row) IN (SELECT * FROM (VALUES {}))'
+    )  # A bare VALUES list makes SQLite scan the whole table instead of the index
+    # Keeps each batch query under SQLite's default limit of 999 parameters
+    _BATCH_SIZE = 300
+    # The page cache is private to each connection, so with the default pool of
+    # 8 connections it totals at most 128 MiB per process. The mmap window maps
+    # the file itself and is shared through the OS page cache across
+    # connections and worker processes, so it is not multiplied.
+    _PRAGMAS = (
+        'PRAGMA query_only = 1',
+        'PRAGMA temp_store = MEMORY',
+        'PRAGMA mmap_size = 1073741824',  # 1 GiB
+        'PRAGMA cache_size = -16384',  # 16 MiB
+    )
+
+    def __init__(self, db_path: Union[str, Path], pool_size: int = 8):
         self.db_path = Path(db_path)
         if not self.db_path.exists():
             raise FileNotFoundError(f"MBTiles file not found: {db_path}")
-    
+        self.pool_size = pool_size
+        # Idle connections; LIFO so the most recently used, warmest one is reused
+        self._pool: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        # Metadata is static for the lifetime of the server, so read it once
+        self._metadata = self._read_metadata()
+        self._is_compressed = not any(
+            "-pC" in opt
+            for opt in self._metadata.get('generator_options', '').split(';')
+        )
+        # MBTiles rows are TMS unless the legacy 'scheme' key says otherwise
+        self._y_flip = self._metadata.get('scheme', 'tms').lower() != 'xyz'
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open a long-lived read-only connection to the MBTiles file
+
+        The file is opened as immutable since it is not expected to change
+        while being served, which lets SQLite skip locking entirely.
+        """
+        uri = f"{self.db_path.resolve().as_uri()}?mode=ro&immutable=1"
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        for pragma in self._PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
     @contextlib.contextmanager
     def get_connection(self):
-        """Create a new connection for each operation"""
-        conn = sqlite3.connect(str(self.db_path))
+        """Check a persistent connection out of the pool for one operation
+
+        At most pool_size connections are ever opened, further callers wait
+        for one to be checked back in.
+        """
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self._lock:
+                if len(self._connections) < self.pool_size:
+                    conn = self._connect()
+                    self._connections.append(conn)
+            if conn is None:
+                conn = self._pool.get()
         try:
             yield conn
         finally:
-            conn.close()
-        
-    def get_metadata(self) -> Dict:
+            self._pool.put(conn)
+
+    def close(self):
+        """Close every pooled connection"""
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+            self._pool = queue.LifoQueue()
+
+    def _read_metadata(self) -> Dict:
         with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT name, value FROM metadata')
-            return {name: value for name, value in cursor.fetchall()}
-    
+            return {name: value for name, value in conn.execute(self._META_SQL)}
+
+    def get_metadata(self) -> Dict:
+        return dict(self._metadata)
+
     def get_tile(self, z: int, x: int, y: int) -> Optional[bytes]:
+        """Fetch a tile by its XYZ coordinates"""
+        tile_row = (1 << z) - 1 - y if self._y_flip else y  # XYZ to TMS conversion
         with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                'SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
-                (z, x, (2**z - 1 - y))  # TMS to XYZ conversion
-            )
-            result = cursor.fetchone()
+            result = conn.execute(self._TILE_SQL, (z, x, tile_row)).fetchone()
             return result[0] if result else None
 
+    def get_tiles(self, coords: Iterable[Tuple[int, int, int]]) -> Dict[Tuple[int, int, int], bytes]:
+        """Fetch many tiles by their XYZ coordinates, skipping missing ones"""
+        rows = {}
+        for z, x, y in coords:
+            tile_row = (1 << z) - 1 - y if self._y_flip else y
+            rows[(z, x, tile_row)] = (z, x, y)
+        keys = list(rows)
+        tiles = {}
+        with self.get_connection() as conn:
+            for start in range(0, len(keys), self._BATCH_SIZE):
+                chunk = keys[start:start + self._BATCH_SIZE]
+                sql = self._TILES_SQL.format(', '.join(['(?, ?, ?)'] * len(chunk)))
+                params = [value for key in chunk for value in key]
+                for z, x, tile_row, tile_data in conn.execute(sql, params):
+                    tiles[rows[(z, x, tile_row)]] = tile_data
+        return tiles
+
     def is_compressed(self) -> bool:
-        metadata = self.get_metadata()
-        return not any(
-            "-pC" in opt 
-            for opt in metadata.get('generator_options', '').split(';')
-        ) 
\ No newline at end of file
+        return self._is_compressed
+
+_TILE_INDEX_COLUMNS = ['zoom_level', 'tile_column', 'tile_row']
+
+def optimize(db_path: Union[str, Path]) -> bool:
+    """Add a covering index to an unindexed tiles table
+
+    Only helps files whose tiles table has no index on (zoom_level,
+    tile_column, tile_row), where lookups otherwise scan the table. Files
+    with such an index, like those from tippecanoe, are left alone since
+    SQLite keeps using it over a covering one, as are tiles views. The index
+    holds a copy of every tile, roughly doubling the file size.
+    Returns True if the index was created.
+    """
+    conn = sqlite3.connect(str(db_path))
+    try:
+        kind = conn.execute("SELECT type FROM sqlite_master WHERE name = 'tiles'").fetchone()
+        if kind is None or kind[0] != 'table':
+            return False  # e.g. tippecanoe's deduplicated tiles view
+        for (index_name,) in conn.execute("SELECT name FROM pragma_index_list('tiles')").fetchall():
+            columns = [name for (name,) in conn.execute(
+                'SELECT name FROM pragma_index_info(?) ORDER BY seqno', (index_name,)
+            )]
+            if columns[:3] == _TILE_INDEX_COLUMNS:
+                return False
+        conn.execute(
+            'CREATE INDEX IF NOT EXISTS tiles_zxy '
+            'ON tiles (zoom_level, tile_column, tile_row, tile_data)'
+        )
+        conn.execute('ANALYZE')
+        conn.commit()
+        return True
+    finally:
+        conn.close()
@@ -1,67 +1,207 @@
 # %%
 #|export
 from pathlib import Path
-from typing import Union, Optional
-from fastapi import FastAPI, HTTPException
+from typing import Union, Optional, List, Tuple
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import Response
+from starlette.concurrency import run_in_threadpool
+from collections import OrderedDict
+from functools import lru_cache
 import logging
-import gzip
+import os
+import secrets
 
-from .core import MBTilesDB
+try:
+    # ISA-L inflates gzip 2-3x faster than the stdlib zlib wrapper
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
+
+from .core import MBTilesDB, flip_y  # flip_y re-exported for existing callers
 
 logger = logging.getLogger(__name__)
 
-def flip_y(zoom: int, y: int) -> int:
-    """Convert between TMS and XYZ tile coordinates"""
-    return (1 << zoom) - 1 - y
+# Upper bound on tiles fetched by a single /tiles/batch request
+MAX_BATCH_TILES = 256
+# Deepest zoom level served
+MAX_ZOOM = 30
+
+# Environment variables read by create_app_factory in each worker process
+MBTILES_FILE_ENV = "SIMPLE_MBTILES_SERVER_MBTILES_FILE"
+STATIC_DIR_ENV = "SIMPLE_MBTILES_SERVER_STATIC_DIR"
+
+# Pre-encoded header templates for tile responses
+_TILE_HEADERS = ((b"content-type", b"application/x-protobuf"),)
+_VARY_HEADER = (b"vary", b"Accept-Encoding")
+# Responses for gzipped tiles depend on Accept-Encoding, so they all carry Vary
+_INFLATED_TILE_HEADERS = _TILE_HEADERS + (_VARY_HEADER,)
+_GZIP_TILE_HEADERS = _TILE_HEADERS + ((b"content-encoding", b"gzip"), _VARY_HEADER)
+_ERROR_HEADERS = ((b"content-type", b"text/plain; charset=utf-8"), _VARY_HEADER)
+_DECOMPRESS_ERROR_BODY = b"Error processing tile data"
 
-def create_app(mbtiles_path: Union[str, Path], static_dir: Optional[str] = None) -> FastAPI:
+def valid_tile(z: int, x: int, y: int) -> bool:
+    """Check that XYZ tile coordinates exist at their zoom level"""
+    return 0 <= z <= MAX_ZOOM and 0 <= x < (1 << z) and 0 <= y < (1 << z)
+
+@lru_cache(maxsize=256)
+def accepts_gzip(accept_encoding: str) -> bool:
+    """Check whether an Accept-Encoding header allows a gzip response
+
+    An explicit gzip coding takes precedence over '*', and a q-value of 0
+    refuses the coding. Cached since clients send a handful of distinct values.
+    """
+    gzip_q = wildcard_q = None
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.partition(";")
+        name = name.strip().lower()
+        if name not in ("gzip", "x-gzip", "*"):
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name == "*":
+            wildcard_q = q
+        else:
+            gzip_q = q
+    if gzip_q is None:
+        gzip_q = wildcard_q
+    return gzip_q is not None and gzip_q > 0
+
+class TileResponse(Response):
+    """Response carrying raw tile bytes with pre-encoded headers
+
+    Skips Starlette's per-response header encoding, only the content length
+    is computed for each response. Response.__init__ is deliberately not
+    called, so this sets the attributes Response.__call__ reads (status_code,
+    body, raw_headers, background) itself and relies on those Starlette
+    internals staying stable.
+    """
+
+    def __init__(self, content: bytes, raw_headers=_TILE_HEADERS, status_code: int = 200):
+        self.status_code = status_code
+        self.background = None
+        self.body = content
+        self.raw_headers = [(b"content-length", str(len(content)).encode()), *raw_headers]
+
+def create_app(
+    mbtiles_path: Union[str, Path],
+    static_dir: Optional[str] = None,
+    tile_cache_size: int = 4096,
+) -> FastAPI:
     app = FastAPI(title="Simple MBTiles Server")
     db = MBTilesDB(mbtiles_path)
+    # The MBTiles file is static while served, so metadata is read once
+    # and recently requested tiles are kept in memory
+    metadata = db.get_metadata()
+    # Files generated with tippecanoe's -pC hold plain tiles, skip the gzip probe
+    compressed = db.is_compressed()
+    # LRU of (z, x, y) -> tile bytes or None, only touched from the event loop
+    tile_cache: "OrderedDict[Tuple[int, int, int], Optional[bytes]]" = OrderedDict()
     
     if static_dir:
         app.mount("/static", StaticFiles(directory=static_dir), name="static")
     
     @app.get("/metadata")
     async def get_metadata():
-        return db.get_metadata()
+        return metadata
     
-    @app.get("/tiles/{z}/{x}/{y}")
-    async def get_tile(z: int, x: int, y: str):
-        # Strip file extension if present
-        xyz_y = int(y.split('.')[0])
+    @app.post("/tiles/batch")
+    def get_tiles_batch(coords: List[Tuple[int, int, int]], request: Request):
+        """Return the requested XYZ tiles as a multipart/mixed body
+
+        Each part is labelled with its tile path in Content-Location; missing
+        tiles are left out. Gzipped tiles are sent as stored with
+        Content-Encoding: gzip when the client accepts gzip, as for single
+        tiles, and inflated here otherwise.
+        """
+        if len(coords) > MAX_BATCH_TILES:
+            raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_TILES} tiles per batch")
+        for z, x, y in coords:
+            if not valid_tile(z, x, y):
+                raise HTTPException(status_code=400, detail=f"Invalid tile coordinate: {z}/{x}/{y}")
         
-        # Convert XYZ to TMS
-        tms_y = flip_y(z, xyz_y)
-        logger.info(f"Tile request - XYZ:{z}/{x}/{xyz_y} -> TMS:{z}/{x}/{tms_y}")
+        tiles = db.get_tiles(coords)
+        send_gzip = accepts_gzip(request.headers.get("accept-encoding", ""))
+        boundary = secrets.token_hex(16)
+        delimiter = f"--{boundary}\r\n".encode()
+        body = []
+        for (z, x, y), tile_data in tiles.items():
+            headers = f"Content-Type: application/x-protobuf\r\nContent-Location: /tiles/{z}/{x}/{y}\r\n"
+            if compressed and len(tile_data) > 1 and tile_data[0] == 0x1f and tile_data[1] == 0x8b:  # gzip magic number
+                if send_gzip:
+                    headers += "Content-Encoding: gzip\r\n"
+                else:
+                    try:
+                        tile_data = gzip.decompress(tile_data)
+                    except Exception as e:
+                        logger.error("Error decompressing tile %d/%d/%d: %s", z, x, y, e)
+                        continue
+            body += [delimiter, headers.encode(), b"\r\n", tile_data, b"\r\n"]
+        body.append(f"--{boundary}--\r\n".encode())
         
-        # Double check if tile exists
-        tile_data = db.get_tile(z, x, tms_y)
+        return Response(
+            content=b"".join(body),
+            media_type=f"multipart/mixed; boundary={boundary}",
+            headers={"Vary": "Accept-Encoding"} if compressed else None
+        )
+    
+    async def get_tile(request: Request):
+        path_params = request.path_params
+        z, x, y = path_params["z"], path_params["x"], path_params["y"]
+        if not (z <= MAX_ZOOM and x < (1 << z) and y < (1 << z)):  # route converters reject negatives
+            return TileResponse(b"", status_code=404)
+        key = (z, x, y)
+        try:
+            tile_data = tile_cache[key]
+            tile_cache.move_to_end(key)
+        except KeyError:
+            # Keep SQLite I/O off the event loop, cache hits never leave it
+            tile_data = await run_in_threadpool(db.get_tile, z, x, y)
+            tile_cache[key] = tile_data
+            if len(tile_cache) > tile_cache_size:
+                tile_cache.popitem(last=False)
         if not tile_data:
-            # Try the original y coordinate as well
-            tile_data = db.get_tile(z, x, xyz_y)
-            if not tile_data:
-                logger.warning(f"Tile not found in database - tried TMS:{z}/{x}/{tms_y} and XYZ:{z}/{x}/{xyz_y}")
-                raise HTTPException(status_code=404, detail="Tile not found")
-            else:
-                logger.info(f"Found tile using XYZ coordinates: {z}/{x}/{xyz_y}")
-        else:
-            logger.info(f"Found tile using TMS coordinates: {z}/{x}/{tms_y}")
+            logger.debug("Tile not found in database: %d/%d/%d", z, x, y)
+            # Misses are common for sparse tilesets, answer them without
+            # going through HTTPException and JSON error rendering
+            return TileResponse(b"", status_code=404)
             
-        # Check if the data is gzipped
-        try:
-            if tile_data.startswith(b'\x1f\x8b'):  # gzip magic number
-                logger.info("Decompressing gzipped tile data")
-                tile_data = gzip.decompress(tile_data)
-        except Exception as e:
-            logger.error(f"Error decompressing tile: {e}")
-            raise HTTPException(status_code=500, detail="Error processing tile data")
+        # Check if the data is gzipped, comparing the magic number bytes as ints
+        # is cheaper than bytes.startswith; -pC files never need the check
+        if compressed and len(tile_data) > 1 and tile_data[0] == 0x1f and tile_data[1] == 0x8b:
+            # Let gzip-capable clients inflate the tile themselves
+            if accepts_gzip(request.headers.get("accept-encoding", "")):
+                return TileResponse(tile_data, _GZIP_TILE_HEADERS)
+            try:
+                tile_data = await run_in_threadpool(gzip.decompress, tile_data)
+            except Exception as e:
+                logger.error("Error decompressing tile %d/%d/%d: %s", z, x, y, e)
+                return TileResponse(_DECOMPRESS_ERROR_BODY, _ERROR_HEADERS, status_code=500)
+            return TileResponse(tile_data, _INFLATED_TILE_HEADERS)
             
-        logger.info(f"Returning tile with size: {len(tile_data)} bytes")
-        return Response(
-            content=tile_data,
-            media_type="application/x-protobuf"
-        )
+        return TileResponse(tile_data)
+    
+    # Tiles are served through plain Starlette routes, bypassing FastAPI's
+    # parameter validation and response handling on the hot path. The
+    # .mvt/.pbf extension is matched by the route itself.
+    app.add_route("/tiles/{z:int}/{x:int}/{y:int}.{ext}", get_tile, methods=["GET"], include_in_schema=False)
+    app.add_route("/tiles/{z:int}/{x:int}/{y:int}", get_tile, methods=["GET"], include_in_schema=False)
     
-    return app 
\ No newline at end of file
+    return app 
+
+def create_app_factory() -> FastAPI:
+    """Create an app configured through the environment
+
+    Used by gunicorn so that every worker process opens its own MBTilesDB
+    after forking, as SQLite connections must not be shared across forks.
+    """
+    return create_app(
+        os.environ[MBTILES_FILE_ENV],
+        static_dir=os.environ.get(STATIC_DIR_ENV)
+    )
@@ -12,19 +12,21 @@ This notebook contains tests for the MBTiles server including:
 # %%
 import sqlite3
 import tempfile
+import threading
 from pathlib import Path
 import json
 from fastapi.testclient import TestClient
 import pytest
 import mapbox_vector_tile
-from typing import Generator
+from typing import Generator, Optional
 from shapely.geometry import Point
 import gzip
 import httpx
 
-from simple_mbtiles_server.core import MBTilesDB
-from simple_mbtiles_server.server import create_app
+from simple_mbtiles_server.core import MBTilesDB, optimize
+from simple_mbtiles_server.server import create_app, create_app_factory, accepts_gzip, MBTILES_FILE_ENV
 from simple_mbtiles_server.config import Config
+from simple_mbtiles_server import cli
 
 # %% [markdown]
 """
@@ -49,6 +51,20 @@ def create_dummy_vector_tile() -> bytes:
     }]
     return mapbox_vector_tile.encode(layers)
 
+# %%
+def seed_mbtiles(path: Path, sql: str, rows: Optional[list] = None) -> None:
+    """Run a statement against an MBTiles file once per parameter row and commit
+
+    Without rows, sql is run as a script, e.g. for schema changes.
+    """
+    conn = sqlite3.connect(path)
+    if rows is None:
+        conn.executescript(sql)
+    else:
+        conn.executemany(sql, rows)
+    conn.commit()
+    conn.close()
+
 # %%
 @pytest.fixture
 def test_mbtiles() -> Generator[Path, None, None]:
@@ -98,6 +114,17 @@ def test_mbtiles() -> Generator[Path, None, None]:
         # Cleanup
         Path(tmp.name).unlink()
 
+# %%
+@pytest.fixture
+def gzipped_client(test_mbtiles):
+    """Create a TestClient for an MBTiles file holding a gzipped tile at XYZ 1/0/0"""
+    seed_mbtiles(
+        test_mbtiles,
+        "INSERT INTO tiles VALUES (?, ?, ?, ?)",
+        [(1, 0, 1, gzip.compress(create_dummy_vector_tile()))]  # TMS row of XYZ y=0
+    )
+    return TestClient(create_app(test_mbtiles))
+
 # %%
 @pytest.fixture
 def test_client(test_mbtiles):
@@ -137,11 +164,143 @@ def test_tile_endpoint(test_client):
     feature = tile_data["test_layer"]["features"][0]
     assert feature["properties"]["name"] == "test_point"
 
+# %%
+def test_tile_endpoint_without_extension(test_client):
+    """Test that tiles can be requested with or without a file extension"""
+    response = test_client.get("/tiles/0/0/0")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-protobuf"
+    assert response.headers["content-length"] == str(len(response.content))
+    assert response.content == test_client.get("/tiles/0/0/0.pbf").content
+    assert test_client.get("/tiles/0/0/abc").status_code == 404
+
+# %%
+def test_tile_cache_hits_skip_threadpool(test_mbtiles, monkeypatch):
+    """Test that cached tiles are served without a threadpool round trip"""
+    import simple_mbtiles_server.server as server
+    calls = []
+    original = server.run_in_threadpool
+    
+    async def counting_run_in_threadpool(func, *args):
+        calls.append(args)
+        return await original(func, *args)
+    
+    monkeypatch.setattr(server, "run_in_threadpool", counting_run_in_threadpool)
+    client = TestClient(create_app(test_mbtiles, tile_cache_size=1))
+    for path in ["/tiles/0/0/0", "/tiles/0/0/0.mvt", "/tiles/1/1/1", "/tiles/1/1/1", "/tiles/0/0/0"]:
+        client.get(path)
+    # Misses are cached too, and caching 1/1/1 evicted 0/0/0
+    assert calls == [(0, 0, 0), (1, 1, 1), (0, 0, 0)]
+
+# %%
+def test_gzipped_tile_passthrough(gzipped_client):
+    """Test that gzipped tiles are sent as-is to clients accepting gzip"""
+    response = gzipped_client.get(
+        "/tiles/1/0/0.mvt",
+        headers={"Accept-Encoding": "gzip"}
+    )
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert "test_layer" in mapbox_vector_tile.decode(response.content)
+
+# %%
+def test_gzipped_tile_inflated_for_identity(gzipped_client):
+    """Test that gzipped tiles are inflated for clients not accepting gzip"""
+    response = gzipped_client.get(
+        "/tiles/1/0/0.mvt",
+        headers={"Accept-Encoding": "identity"}
+    )
+    assert response.status_code == 200
+    assert "content-encoding" not in response.headers
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert "test_layer" in mapbox_vector_tile.decode(response.content)
+    
+    refused = gzipped_client.get("/tiles/1/0/0.mvt", headers={"Accept-Encoding": "gzip;q=0, deflate"})
+    assert "content-encoding" not in refused.headers
+    assert refused.content == response.content
+
+# %%
+def test_accepts_gzip():
+    """Test Accept-Encoding parsing including q-values and wildcards"""
+    assert accepts_gzip("gzip")
+    assert accepts_gzip("deflate, GZIP;q=0.5")
+    assert accepts_gzip("*")
+    assert not accepts_gzip("")
+    assert not accepts_gzip("identity")
+    assert not accepts_gzip("gzip;q=0")
+    assert not accepts_gzip("gzip; q=0.0, br")
+    assert not accepts_gzip("*, gzip;q=0")
+    assert not accepts_gzip("*;q=0")
+
 # %%
 def test_missing_tile(test_client):
     """Test requesting a non-existent tile"""
     response = test_client.get("/tiles/1/1/1.mvt")
     assert response.status_code == 404
+    assert response.content == b""
+
+# %%
+def post_batch(client: TestClient, coords: list, accept_encoding: str) -> dict:
+    """POST a batch request and split the multipart body into {location: (headers, data)}"""
+    response = client.post("/tiles/batch", json=coords, headers={"Accept-Encoding": accept_encoding})
+    assert response.status_code == 200
+    assert response.headers["vary"] == "Accept-Encoding"
+    content_type = response.headers["content-type"]
+    assert content_type.startswith("multipart/mixed; boundary=")
+    boundary = content_type.split("boundary=")[1].encode()
+    
+    parts = response.content.split(b"--" + boundary)
+    assert parts[-1] == b"--\r\n"
+    tiles = {}
+    for part in parts[1:-1]:
+        headers, tile_data = part.strip(b"\r\n").split(b"\r\n\r\n", 1)
+        tiles[headers.split(b"Content-Location: ")[1].split(b"\r\n")[0]] = (headers, tile_data)
+    return tiles
+
+# %%
+def test_batch_tile_endpoint(gzipped_client):
+    """Test fetching several tiles in one multipart/mixed response"""
+    tiles = post_batch(gzipped_client, [[0, 0, 0], [1, 0, 0], [1, 1, 1]], "gzip")
+    assert sorted(tiles) == [b"/tiles/0/0/0", b"/tiles/1/0/0"]
+    assert b"Content-Encoding: gzip" in tiles[b"/tiles/1/0/0"][0]
+    assert "test_layer" in mapbox_vector_tile.decode(gzip.decompress(tiles[b"/tiles/1/0/0"][1]))
+    assert "test_layer" in mapbox_vector_tile.decode(tiles[b"/tiles/0/0/0"][1])
+
+# %%
+def test_batch_inflates_for_identity(gzipped_client):
+    """Test that batch parts are inflated for clients not accepting gzip"""
+    tiles = post_batch(gzipped_client, [[1, 0, 0]], "gzip;q=0")
+    headers, tile_data = tiles[b"/tiles/1/0/0"]
+    assert b"Content-Encoding" not in headers
+    assert "test_layer" in mapbox_vector_tile.decode(tile_data)
+
+# %%
+@pytest.mark.parametrize("coord", [[-1, 0, 0], [0, 0, 2**70], [31, 0, 0], [1, 2, 0], [2, 0, -1]])
+def test_batch_rejects_invalid_coordinates(test_client, coord):
+    """Test that out-of-range batch coordinates are rejected with a 400"""
+    response = test_client.post("/tiles/batch", json=[[0, 0, 0], coord])
+    assert response.status_code == 400
+
+# %%
+@pytest.mark.parametrize("path", ["/tiles/70/0/0", "/tiles/0/99999999999999999999/0", "/tiles/1/0/2.mvt", "/tiles/31/0/0"])
+def test_tile_rejects_invalid_coordinates(test_client, path):
+    """Test that out-of-range tile coordinates return an empty 404"""
+    response = test_client.get(path)
+    assert response.status_code == 404
+    assert response.content == b""
+
+# %%
+def test_corrupt_gzipped_tile(test_mbtiles):
+    """Test that a tile that fails to inflate returns a plain 500"""
+    seed_mbtiles(test_mbtiles, "INSERT INTO tiles VALUES (1, 1, 1, ?)", [(b"\x1f\x8bnot gzip",)])
+    
+    response = TestClient(create_app(test_mbtiles)).get(
+        "/tiles/1/1/0.mvt",
+        headers={"Accept-Encoding": "identity"}
+    )
+    assert response.status_code == 500
+    assert response.text == "Error processing tile data"
 
 # %%
 def test_mbtiles_db_connection(test_mbtiles):
@@ -156,6 +315,8 @@ def test_mbtiles_db_connection(test_mbtiles):
     # Verify tile content
     tile_data = mapbox_vector_tile.decode(tile)
     assert "test_layer" in tile_data 
+    
+    assert db.get_tiles([(0, 0, 0), (1, 1, 1)]) == {(0, 0, 0): tile}
 
 # %%
 def test_custom_port(test_mbtiles):
@@ -171,4 +332,120 @@ def test_custom_port(test_mbtiles):
     
     # Test that metadata endpoint works
     response = client.get("/metadata")
-    assert response.status_code == 200 
\ No newline at end of file
+    assert response.status_code == 200 
+
+# %%
+def test_mbtiles_db_connection_reuse(test_mbtiles):
+    """Test that MBTilesDB reuses pooled read-only connections"""
+    db = MBTilesDB(test_mbtiles)
+    with db.get_connection() as first:
+        with pytest.raises(sqlite3.OperationalError):
+            first.execute("DELETE FROM tiles")
+    with db.get_connection() as second:
+        assert first is second
+    db.close()
+
+# %%
+def test_mbtiles_db_pool_is_bounded(test_mbtiles):
+    """Test that lookups from many short-lived threads never exceed the pool size"""
+    db = MBTilesDB(test_mbtiles, pool_size=3)
+    barrier = threading.Barrier(10)
+    
+    def lookup():
+        barrier.wait()
+        for _ in range(20):
+            assert db.get_tile(0, 0, 0) is not None
+    
+    for _ in range(3):  # Successive bursts on fresh threads that then exit
+        threads = [threading.Thread(target=lookup) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(db._connections) <= 3
+    db.close()
+
+# %%
+def test_is_compressed_read_at_startup(test_mbtiles):
+    """Test that compression is decided once from the generator options"""
+    seed_mbtiles(
+        test_mbtiles,
+        "UPDATE metadata SET value = ? WHERE name = 'generator_options'",
+        [("tippecanoe -o out.mbtiles; -pC",)]
+    )
+
+    db = MBTilesDB(test_mbtiles)
+    assert db.is_compressed() is False
+    assert db.get_metadata()["generator_options"].endswith("-pC")
+
+# %%
+def test_xyz_scheme_rows_not_flipped(test_mbtiles):
+    """Test that files declaring the xyz scheme are read without flipping y"""
+    seed_mbtiles(test_mbtiles, "INSERT INTO metadata VALUES (?, ?)", [("scheme", "xyz")])
+    seed_mbtiles(
+        test_mbtiles,
+        "INSERT INTO tiles VALUES (?, ?, ?, ?)",
+        [(1, 0, 0, create_dummy_vector_tile())]
+    )
+
+    db = MBTilesDB(test_mbtiles)
+    assert db.get_tile(1, 0, 0) is not None
+    assert db.get_tile(1, 0, 1) is None
+
+# %%
+def test_create_app_factory(test_mbtiles, monkeypatch):
+    """Test that worker processes build the app from the environment"""
+    monkeypatch.setenv(MBTILES_FILE_ENV, str(test_mbtiles))
+    client = TestClient(create_app_factory())
+    response = client.get("/metadata")
+    assert response.status_code == 200
+    assert response.json()["name"] == "test_tiles"
+
+# %%
+def test_serve_single_process_on_windows(test_mbtiles, monkeypatch):
+    """Test that multiple workers fall back to one uvicorn process on Windows"""
+    served = []
+    monkeypatch.setattr(cli.os, "name", "nt")
+    monkeypatch.setattr(cli, "create_app", lambda *args, **kwargs: "app")
+    monkeypatch.setattr(cli.uvicorn, "run", lambda app, **kwargs: served.append(app))
+    monkeypatch.setattr(cli, "run_gunicorn", lambda config: pytest.fail("gunicorn used on Windows"))
+    
+    cli.serve(Config(mbtiles_file=test_mbtiles, workers=4))
+    assert served == ["app"]
+
+# %%
+def test_optimize_adds_covering_index(test_mbtiles):
+    """Test that optimize indexes unindexed tiles once and the index is used"""
+    seed_mbtiles(
+        test_mbtiles,
+        "INSERT INTO tiles VALUES (?, ?, ?, ?)",
+        [(8, x, x, b"tile") for x in range(100)]  # enough rows for the planner to prefer the index
+    )
+    
+    assert optimize(test_mbtiles) is True
+    assert optimize(test_mbtiles) is False
+    
+    db = MBTilesDB(test_mbtiles)
+    with db.get_connection() as conn:
+        plan = conn.execute("EXPLAIN QUERY PLAN " + db._TILE_SQL, (0, 0, 0)).fetchall()
+    assert "COVERING INDEX tiles_zxy" in plan[0][-1]
+    assert db.get_tile(0, 0, 0) is not None
+
+# %%
+def test_optimize_skips_indexed_tiles_and_views(test_mbtiles):
+    """Test that optimize leaves indexed tiles tables and tiles views unchanged"""
+    seed_mbtiles(test_mbtiles, "CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)")
+    assert optimize(test_mbtiles) is False
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        view_mbtiles = Path(tmp_dir) / "view.mbtiles"
+        seed_mbtiles(view_mbtiles, """
+            CREATE TABLE map (zoom_level, tile_column, tile_row, tile_id);
+            CREATE VIEW tiles AS SELECT * FROM map;
+        """)
+        assert optimize(view_mbtiles) is False
+    
+    conn = sqlite3.connect(test_mbtiles)
+    index_names = [name for (name,) in conn.execute("SELECT name FROM pragma_index_list('tiles')")]
+    conn.close()
+    assert index_names == ["tile_index"]
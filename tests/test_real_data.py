@@ -8,6 +8,7 @@ import sqlite3
 import logging
 import os
 import gzip
+from collections import defaultdict
 
 from simple_mbtiles_server.server import create_app, flip_y
 
@@ -15,7 +16,7 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # %%
-@pytest.fixture
+@pytest.fixture(scope="session")
 def scram_mbtiles():
     # Try multiple path formats using environment variables
     paths_to_try = [
@@ -34,11 +35,17 @@ def scram_mbtiles():
             
     raise FileNotFoundError(f"Could not find MBTiles file in any of: {paths_to_try}")
 
+@pytest.fixture(scope="session")
+def scram_conn(scram_mbtiles):
+    """Single connection to the SCRAM MBTiles file shared by all tests"""
+    conn = sqlite3.connect(scram_mbtiles, check_same_thread=False)
+    yield conn
+    conn.close()
+
 @pytest.fixture
-def tile_coords(scram_mbtiles):
+def tile_coords(scram_conn):
     """Get actual tile coordinates from the MBTiles file"""
-    conn = sqlite3.connect(scram_mbtiles)
-    cur = conn.cursor()
+    cur = scram_conn.cursor()
     
     # First, check the table structure
     cur.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='tiles'")
@@ -60,8 +67,6 @@ def tile_coords(scram_mbtiles):
     for t in tiles:
         logger.info(f"Raw tile from DB (TMS) - z:{t[0]} x:{t[1]} y:{t[2]} size:{t[3]}")
     
-    conn.close()
-    
     # Keep the TMS coordinates - don't convert them
     tms_tiles = [(t[0], t[1], t[2]) for t in tiles]
     
@@ -89,7 +94,7 @@ def test_metadata_endpoint(client):
     assert "format" in metadata
 
 # %%
-def test_tile_content(client, tile_coords, scram_mbtiles):
+def test_tile_content(client, tile_coords):
     """Test that we can get actual tile data from the SCRAM mbtiles"""
     if not tile_coords:
         pytest.skip("No tiles found in database")
@@ -99,26 +104,10 @@ def test_tile_content(client, tile_coords, scram_mbtiles):
     xyz_y = flip_y(z, tms_y)  # Convert to XYZ for request
     logger.info(f"Testing tile - TMS:{z}/{x}/{tms_y} -> XYZ:{z}/{x}/{xyz_y}")
     
-    # Double-check the tile exists in the database (using TMS coordinates)
-    conn = sqlite3.connect(scram_mbtiles)
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT tile_data
-        FROM tiles 
-        WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?
-    """, (z, x, tms_y))
-    result = cur.fetchone()
-    if result:
-        raw_data = result[0]
-        logger.info(f"Raw tile size: {len(raw_data)} bytes")
-        # Use bytes literal outside f-string
-        gzip_header = b'\x1f\x8b'
-        logger.info(f"Starts with gzip magic number: {raw_data.startswith(gzip_header)}")
-    conn.close()
-    
     # Request using XYZ coordinates
     response = client.get(f"/tiles/{z}/{x}/{xyz_y}")
     assert response.status_code == 200, f"Failed to get tile at XYZ:{z}/{x}/{xyz_y} (TMS:{z}/{x}/{tms_y})"
+    logger.info(f"Tile content encoding: {response.headers.get('content-encoding', 'identity')}")
     
     # Try to decode the vector tile
     try:
@@ -142,7 +131,7 @@ def test_tile_content(client, tile_coords, scram_mbtiles):
         raise
 
 # %%
-def test_specific_tiles(client, tile_coords, scram_mbtiles):
+def test_specific_tiles(client, tile_coords):
     """Test specific tile coordinates from the database"""
     if not tile_coords:
         pytest.skip("No tiles found in database")
@@ -151,20 +140,6 @@ def test_specific_tiles(client, tile_coords, scram_mbtiles):
         xyz_y = flip_y(z, tms_y)  # Convert to XYZ for request
         logger.info(f"\nTesting tile - TMS:{z}/{x}/{tms_y} -> XYZ:{z}/{x}/{xyz_y}")
         
-        # Check database directly (using TMS coordinates)
-        conn = sqlite3.connect(scram_mbtiles)
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT LENGTH(tile_data) 
-            FROM tiles 
-            WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?
-        """, (z, x, tms_y))
-        result = cur.fetchone()
-        logger.info(f"Database check for tile (TMS) {z}/{x}/{tms_y}: {'Found' if result else 'Not found'}")
-        if result:
-            logger.info(f"Tile size in database: {result[0]} bytes")
-        conn.close()
-        
         # Request using XYZ coordinates
         response = client.get(f"/tiles/{z}/{x}/{xyz_y}")
         assert response.status_code == 200
@@ -187,10 +162,9 @@ def test_specific_tiles(client, tile_coords, scram_mbtiles):
 # This test prints a comprehensive report about the MBTiles content directly to console
 
 # %%
-def test_mbtiles_data_report(scram_mbtiles):
+def test_mbtiles_data_report(scram_conn):
     """Generate a comprehensive report about the MBTiles data content"""
-    conn = sqlite3.connect(scram_mbtiles)
-    cur = conn.cursor()
+    cur = scram_conn.cursor()
     
     print("\n" + "="*50)
     print("MBTILES DATA REPORT")
@@ -202,31 +176,28 @@ def test_mbtiles_data_report(scram_mbtiles):
     print("\n=== MBTiles Metadata ===")
     print(json.dumps(metadata, indent=2))
     
-    # Analyze zoom levels and tile counts
+    # Analyze zoom levels and tile counts, sampling a tile from each zoom level
+    # in the same query (tiles may be a view, so no rowid tricks)
     cur.execute("""
-        SELECT zoom_level, COUNT(*) as tile_count
-        FROM tiles
-        GROUP BY zoom_level
+        SELECT zoom_level, tile_count,
+               (SELECT tile_data FROM tiles AS t WHERE t.zoom_level = s.zoom_level LIMIT 1)
+        FROM (
+            SELECT zoom_level, COUNT(*) as tile_count
+            FROM tiles
+            GROUP BY zoom_level
+        ) AS s
         ORDER BY zoom_level
     """)
     zoom_stats = cur.fetchall()
     print("\n=== Zoom Level Statistics ===")
-    for zoom, count in zoom_stats:
+    for zoom, count, _ in zoom_stats:
         print(f"Zoom {zoom}: {count} tiles")
     
-    # Sample a tile from each zoom level to analyze content
+    # Analyze the sampled tile content
     print("\n=== Layer Analysis by Zoom Level ===")
-    for zoom_level, _ in zoom_stats:
-        cur.execute("""
-            SELECT tile_data 
-            FROM tiles 
-            WHERE zoom_level = ? 
-            LIMIT 1
-        """, (zoom_level,))
-        tile_data = cur.fetchone()[0]
-        
+    for zoom_level, _, tile_data in zoom_stats:
         # Decompress if necessary
-        if tile_data.startswith(b'\x1f\x8b'):
+        if len(tile_data) > 1 and tile_data[0] == 0x1f and tile_data[1] == 0x8b:  # gzip magic number
             tile_data = gzip.decompress(tile_data)
             
         try:
@@ -256,14 +227,16 @@ def test_mbtiles_data_report(scram_mbtiles):
                             
                     # Get unique property values for categorical fields
                     if feature_count < 1000:  # Limit analysis to avoid memory issues
-                        for prop in sample_props.keys():
-                            values = {f['properties'].get(prop) 
-                                    for f in layer['features']}
-                            if len(values) < 10:  # Only show if small number of unique values
-                                print(f"  {prop} unique values: {sorted(values)}")
+                        # Collect values for every property in a single pass over the features
+                        values = defaultdict(set)
+                        for f in layer['features']:
+                            for prop, value in f['properties'].items():
+                                values[prop].add(value)
+                        for prop, prop_values in values.items():
+                            if len(prop_values) < 10:  # Only show if small number of unique values
+                                print(f"  {prop} unique values: {sorted(prop_values)}")
         
         except Exception as e:
             print(f"Error analyzing tile at zoom {zoom_level}: {e}")
     
-    print("\n" + "="*50 + "\n")
-    conn.close() 
\ No newline at end of file
+    print("\n" + "="*50 + "\n") 
\ No newline at end of file